@@ -751,23 +751,30 @@ def compile_multiple(sources, options):
     verbose = options.verbose
     context = None
     cwd = os.getcwd()
-    for source in sources:
-        if source not in processed:
-            if context is None:
-                context = options.create_context()
-            output_filename = get_output_filename(source, cwd, options)
-            out_of_date = context.c_file_out_of_date(source, output_filename)
-            if (not timestamps) or out_of_date:
-                if verbose:
-                    sys.stderr.write("Compiling %s\n" % source)
-                result = run_pipeline(source, options,
-                                      full_module_name=options.module_name,
-                                      context=context)
-                results.add(source, result)
-                # Compiling multiple sources in one context doesn't quite
-                # work properly yet.
-                context = None
-            processed.add(source)
+    # file timestamps are cached while checking the sources below
+    Utils.enable_stat_cache()
+    try:
+        for source in sources:
+            if source not in processed:
+                if context is None:
+                    context = options.create_context()
+                output_filename = get_output_filename(source, cwd, options)
+                out_of_date = context.c_file_out_of_date(source, output_filename)
+                if (not timestamps) or out_of_date:
+                    if verbose:
+                        sys.stderr.write("Compiling %s\n" % source)
+                    result = run_pipeline(source, options,
+                                          full_module_name=options.module_name,
+                                          context=context)
+                    # the compilation has written its output files
+                    Utils.clear_stat_cache()
+                    results.add(source, result)
+                    # Compiling multiple sources in one context doesn't quite
+                    # work properly yet.
+                    context = None
+                processed.add(source)
+    finally:
+        Utils.disable_stat_cache()
     return results
 
 
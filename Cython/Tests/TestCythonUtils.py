@@ -1,6 +1,16 @@
+import io
+import os
+import shutil
+import tempfile
 import unittest
 
-from ..Utils import build_hex_version
+from .. import Utils
+from ..Utils import (
+    build_hex_version, cached_function, cached_method, captured_fd, check_package_dir,
+    clear_function_caches, detect_opened_file_encoding, disable_stat_cache,
+    enable_stat_cache, find_root_package_dir, invalidate_stat, is_package_dir,
+    modification_time, open_new_file, open_source_file, replace_suffix,
+    str_to_number, OrderedSet)
 
 class TestCythonUtils(unittest.TestCase):
     def test_build_hex_version(self):
@@ -9,3 +19,216 @@ class TestCythonUtils(unittest.TestCase):
         self.assertEqual('0x001D03C4', build_hex_version('0.29.3rc4'))
         self.assertEqual('0x001D00F0', build_hex_version('0.29'))
         self.assertEqual('0x040000F0', build_hex_version('4.0'))
+        self.assertEqual('0x030A00B2', build_hex_version('3.10b2'))
+        self.assertEqual('0x010203FF', build_hex_version('1.2.3.15'))
+        self.assertRaises(ValueError, build_hex_version, '1.2b')
+        self.assertRaises(ValueError, build_hex_version, '1.2.')
+        self.assertRaises(ValueError, build_hex_version, '')
+        self.assertRaises(ValueError, build_hex_version, 'a1')
+        self.assertRaises(ValueError, build_hex_version, '.1')
+
+    def test_cached_function(self):
+        calls = []
+        @cached_function
+        def f(x):
+            calls.append(x)
+            return x * 2
+        self.assertEqual(4, f(2))
+        self.assertEqual(4, f(2))
+        self.assertEqual([2], calls)
+        self.assertEqual(4, f.uncached(2))
+        self.assertEqual([2, 2], calls)
+        self.assertEqual('f', f.__name__)
+        self.assertTrue(f.__wrapped__ is f.uncached)
+        clear_function_caches()
+        self.assertEqual(4, f(2))
+        self.assertEqual([2, 2, 2], calls)
+
+    def test_cached_method(self):
+        class Cached(object):
+            def __init__(self):
+                self.calls = 0
+            @cached_method
+            def compute(self, x):
+                self.calls += 1
+                if x < 0:
+                    raise ValueError(x)
+                return x + 1
+
+        obj = Cached()
+        self.assertEqual(2, obj.compute(1))
+        self.assertEqual(2, obj.compute(1))
+        self.assertEqual(3, obj.compute(2))
+        self.assertEqual(2, obj.calls)
+        try:
+            obj.compute(-1)
+        except ValueError as exc:
+            # the cache miss must not leak into the exception context
+            self.assertTrue(getattr(exc, '__context__', None) is None)
+        else:
+            self.fail("ValueError not raised")
+
+    def test_is_package_dir(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            package_dir = os.path.join(temp_dir, 'pkg')
+            plain_dir = os.path.join(temp_dir, 'plain')
+            os.mkdir(package_dir)
+            os.mkdir(plain_dir)
+            open(os.path.join(package_dir, '__init__.pxd'), 'w').close()
+            open(os.path.join(plain_dir, 'module.py'), 'w').close()
+            self.assertTrue(is_package_dir(package_dir))
+            self.assertFalse(is_package_dir(plain_dir))
+            self.assertFalse(is_package_dir(os.path.join(temp_dir, 'missing')))
+        finally:
+            shutil.rmtree(temp_dir)
+            clear_function_caches()
+
+    def test_is_package_dir_in_loader_archive(self):
+        archive = os.path.join(tempfile.gettempdir(), 'missing_archive.zip')
+        class FakeZipLoader(object):
+            def get_data(self, name):
+                if name != os.path.join('pkg', '__init__.py'):
+                    raise IOError(name)
+                return b''
+        loader = FakeZipLoader()
+        loader.archive = archive
+        orig_loader = Utils.__loader__
+        Utils.__loader__ = loader
+        try:
+            self.assertTrue(is_package_dir(os.path.join(archive, 'pkg')))
+            self.assertFalse(is_package_dir(os.path.join(archive, 'other')))
+            self.assertFalse(is_package_dir(os.path.join(tempfile.gettempdir(), 'no_such_dir', 'pkg')))
+        finally:
+            Utils.__loader__ = orig_loader
+            clear_function_caches()
+
+    def test_str_to_number(self):
+        self.assertEqual(0, str_to_number('0'))
+        self.assertEqual(7, str_to_number('7'))
+        self.assertEqual(-12, str_to_number('-12'))
+        self.assertEqual(0x1AF, str_to_number('0x1AF'))
+        self.assertEqual(0x1AF, str_to_number('0X1af'))
+        self.assertEqual(0o136, str_to_number('0o136'))
+        self.assertEqual(0o136, str_to_number('0O136'))
+        self.assertEqual(5, str_to_number('0b101'))
+        self.assertEqual(-5, str_to_number('-0B101'))
+        self.assertEqual(0o136, str_to_number('0136'))
+
+    def test_detect_opened_file_encoding(self):
+        def detect(source):
+            return detect_opened_file_encoding(io.BytesIO(source))
+        self.assertEqual('UTF-8', detect(b''))
+        self.assertEqual('UTF-8', detect(b'x = 1\ny = 2\n'))
+        self.assertEqual('latin-1', detect(b'# -*- coding: latin-1 -*-\nx = 1\n'))
+        self.assertEqual('latin-1', detect(b'#!/usr/bin/env python\n# coding=latin-1\n'))
+        self.assertEqual('latin-1', detect(b'# cython: c_string_encoding=ascii\n# coding: latin-1\n'))
+        self.assertEqual('UTF-8', detect(b'# cython: c_string_encoding=ascii\nx = 1\n'))
+        self.assertEqual('UTF-8', detect(b'x = 1\ny = 2\n# coding: latin-1\n'))
+        self.assertEqual('latin-1', detect(b'#' * 2000 + b'\n# coding: latin-1\n'))
+        self.assertEqual('latin-1', detect(b'#' * 5000 + b'\n# coding: latin-1\n'))
+        self.assertEqual('latin-1', detect(b'# coding: latin-1\n' + b'#' * 5000))
+        self.assertEqual('ascii', detect_opened_file_encoding(io.BytesIO(b'x = 1\n'), default='ascii'))
+
+    def test_ordered_set(self):
+        s = OrderedSet([3, 1, 3])
+        s.add(2)
+        s.add(1)
+        s.update([5, 2, 4])
+        self.assertEqual([3, 1, 2, 5, 4], list(s))
+
+    def test_open_source_file(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(temp_dir, 'source.pyx')
+            for source, expected in [
+                    (b'x = 1\n', u'x = 1\n'),
+                    (b'\xef\xbb\xbfx = "\xc3\xa9"\n', u'x = "\xe9"\n'),
+                    (b'\xef\xbb\xbf# coding: utf8\n', u'# coding: utf8\n'),
+                    (b'# coding: latin-1\nx = "\xe9"\n', u'# coding: latin-1\nx = "\xe9"\n'),
+                    ]:
+                with open(path, 'wb') as f:
+                    f.write(source)
+                with open_source_file(path) as f:
+                    self.assertEqual(expected, f.read())
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_modification_time_cache(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(temp_dir, 'output.c')
+            open_new_file(path).close()
+            os.utime(path, (1000, 1000))
+            self.assertEqual(1000, modification_time(path))
+            os.utime(path, (2000, 2000))
+            self.assertEqual(2000, modification_time(path))  # not cached by default
+
+            enable_stat_cache()
+            try:
+                self.assertEqual(2000, modification_time(path))
+                os.utime(path, (3000, 3000))
+                self.assertEqual(2000, modification_time(path))  # cached
+                invalidate_stat(path)
+                self.assertEqual(3000, modification_time(path))
+            finally:
+                disable_stat_cache()
+
+            os.utime(path, (4000, 4000))
+            self.assertEqual(4000, modification_time(path))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_check_package_dir(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            package_dir = os.path.join(temp_dir, 'pkg', 'sub')
+            os.makedirs(package_dir)
+            open(os.path.join(temp_dir, 'pkg', '__init__.py'), 'w').close()
+            self.assertEqual(None, check_package_dir(temp_dir, ('pkg', 'sub')))
+            self.assertEqual(None, check_package_dir(temp_dir, ('missing', 'sub')))
+            self.assertEqual(None, check_package_dir(os.path.join(temp_dir, 'missing'), ('pkg',)))
+            clear_function_caches()
+            open(os.path.join(package_dir, '__init__.py'), 'w').close()
+            self.assertEqual(package_dir, check_package_dir(temp_dir, ('pkg', 'sub')))
+            self.assertEqual(os.path.join(temp_dir, 'pkg'), check_package_dir(temp_dir, ('pkg',)))
+            module_path = os.path.join(package_dir, 'module.pyx')
+            self.assertEqual(temp_dir, find_root_package_dir(module_path))
+            self.assertEqual(temp_dir, find_root_package_dir.uncached(module_path))
+            self.assertEqual(temp_dir, find_root_package_dir(os.path.join(temp_dir, 'module.pyx')))
+            # packages created after an earlier lookup in the same parent directory must be found
+            new_package_dir = os.path.join(temp_dir, 'newpkg')
+            os.mkdir(new_package_dir)
+            open(os.path.join(new_package_dir, '__init__.py'), 'w').close()
+            self.assertEqual(new_package_dir, check_package_dir(temp_dir, ('newpkg',)))
+            root = os.path.abspath(os.sep)
+            self.assertEqual(root, find_root_package_dir(root))
+        finally:
+            shutil.rmtree(temp_dir)
+            clear_function_caches()
+
+    def test_captured_fd(self):
+        with captured_fd(1) as get_stdout:
+            os.write(1, b'abc')
+            self.assertEqual(b'abc', get_stdout())
+            os.write(1, b'def')
+            self.assertEqual(b'abcdef', get_stdout())
+            self.assertEqual(b'abcdef', get_stdout())
+            os.write(1, b'ghi')
+        self.assertEqual(b'abcdefghi', get_stdout())
+
+        try:
+            with captured_fd(2, encoding='ascii') as get_stderr:
+                os.write(2, b'error')
+                raise ValueError()
+        except ValueError:
+            pass
+        else:
+            self.fail("exception not propagated")
+        self.assertEqual(u'error', get_stderr())
+
+    def test_replace_suffix(self):
+        for path in ['module.pyx', 'dir/module.pyx', 'dir.d/module', 'dir/module.tar.gz', 'module',
+                     '.hidden', 'dir/..hidden', 'dir/.hidden.pyx', 'dir/module.', '.', '..', '', 'dir/',
+                     os.path.join('a.b', 'c.pyx'), os.path.join('a.b', 'c')]:
+            self.assertEqual(os.path.splitext(path)[0] + '.c', replace_suffix(path, '.c'), path)
@@ -15,6 +15,11 @@ try:
 except NameError:
     FileNotFoundError = OSError
 
+try:
+    intern
+except NameError:
+    from sys import intern
+
 import os
 import sys
 import re
@@ -22,43 +27,101 @@ import io
 import codecs
 import shutil
 import tempfile
-from contextlib import contextmanager
 
-modification_time = os.path.getmtime
+try:
+    from functools import lru_cache
+except ImportError:
+    # Py2
+    lru_cache = None
 
 _function_caches = []
 def clear_function_caches():
-    for cache in _function_caches:
-        cache.clear()
+    for clear_cache in _function_caches:
+        clear_cache()
 
 def cached_function(f):
+    if lru_cache is not None:
+        # The C implementation of lru_cache does the argument lookup without Python overhead.
+        wrapper = lru_cache(maxsize=None)(f)
+        _function_caches.append(wrapper.cache_clear)
+        wrapper.uncached = f
+        return wrapper
+
     cache = {}
-    _function_caches.append(cache)
+    _function_caches.append(cache.clear)
     uncomputed = object()
     def wrapper(*args):
         res = cache.get(args, uncomputed)
         if res is uncomputed:
             res = cache[args] = f(*args)
         return res
-    wrapper.uncached = f
+    # copy only the basic metadata, update_wrapper() is slow during imports
+    wrapper.__name__ = f.__name__
+    wrapper.__doc__ = f.__doc__
+    wrapper.__wrapped__ = wrapper.uncached = f
     return wrapper
 
 def cached_method(f):
-    cache_name = '__%s_cache' % f.__name__
+    cache_name = intern('__%s_cache' % f.__name__)
     def wrapper(self, *args):
-        cache = getattr(self, cache_name, None)
-        if cache is None:
-            cache = {}
-            setattr(self, cache_name, cache)
-        if args in cache:
+        # Access the instance dict directly to avoid the attribute lookup machinery.
+        instance_dict = self.__dict__
+        try:
+            cache = instance_dict[cache_name]
+        except KeyError:
+            cache = instance_dict[cache_name] = {}
+        # Cache hits are by far the most common case.
+        try:
             return cache[args]
+        except KeyError:
+            pass
+        # call outside of the except clause to avoid chaining the KeyError to its exceptions
         res = cache[args] = f(self, *args)
         return res
     return wrapper
 
+# stat() results can be cached while checking the timestamps of many files in one build,
+# see compile_multiple(). Outside of enable_stat_cache() / disable_stat_cache(), nothing is cached.
+_stat_cache = None
+
+def cached_stat(path):
+    if _stat_cache is None:
+        return os.stat(path)
+    st = _stat_cache.get(path)
+    if st is None:
+        st = _stat_cache[path] = os.stat(path)
+    return st
+
+def invalidate_stat(path):
+    if _stat_cache is not None:
+        _stat_cache.pop(path, None)
+
+def clear_stat_cache():
+    if _stat_cache is not None:
+        _stat_cache.clear()
+
+def enable_stat_cache():
+    global _stat_cache
+    _stat_cache = {}
+
+def disable_stat_cache():
+    global _stat_cache
+    _stat_cache = None
+
+def modification_time(path):
+    return cached_stat(path).st_mtime
+
 def replace_suffix(path, newsuf):
-    base, _ = os.path.splitext(path)
-    return base + newsuf
+    # Same as "os.path.splitext(path)[0] + newsuf", but without the generic splitext() overhead.
+    dot_index = path.rfind('.')
+    if dot_index != -1:
+        sep_index = path.rfind(os.sep)
+        if os.altsep:
+            sep_index = max(sep_index, path.rfind(os.altsep))
+        # like splitext(), ignore leading dots of the file name ('.hidden')
+        if dot_index > sep_index and path[sep_index+1:dot_index].strip('.'):
+            path = path[:dot_index]
+    return path + newsuf
 
 
 def open_new_file(path):
@@ -91,6 +154,7 @@ def castrate_file(path, st):
         f.close()
         if st:
             os.utime(path, (st.st_atime, st.st_mtime-1))
+            invalidate_stat(path)
 
 def file_newer_than(path, time):
     ftime = modification_time(path)
@@ -122,17 +186,16 @@ def copy_file_to_dir_if_newer(sourcefile, destdir):
         if not file_newer_than(sourcefile, desttime):
             return
     shutil.copy2(sourcefile, destfile)
+    invalidate_stat(destfile)
 
 
 @cached_function
 def find_root_package_dir(file_path):
     dir = os.path.dirname(file_path)
-    if file_path == dir:
-        return dir
-    elif is_package_dir(dir):
-        return find_root_package_dir(dir)
-    else:
-        return dir
+    while dir != file_path and is_package_dir(dir):
+        file_path = dir
+        dir = os.path.dirname(dir)
+    return dir
 
 @cached_function
 def check_package_dir(dir, package_names):
@@ -142,12 +205,14 @@ def check_package_dir(dir, package_names):
             return None
     return dir
 
+PACKAGE_FILES = ("__init__.py", "__init__.pyc", "__init__.pyx", "__init__.pxd")
+
 @cached_function
 def is_package_dir(dir_path):
-    for filename in ("__init__.py",
-                     "__init__.pyc",
-                     "__init__.pyx",
-                     "__init__.pxd"):
+    if not os.path.isdir(dir_path) and not _in_loader_archive(dir_path):
+        # Missing directories are the common negative case, don't probe each package file.
+        return None
+    for filename in PACKAGE_FILES:
         path = os.path.join(dir_path, filename)
         if path_exists(path):
             return 1
@@ -157,34 +222,47 @@ def path_exists(path):
     # try on the filesystem first
     if os.path.exists(path):
         return True
-    # figure out if a PEP 302 loader is around
+    return _path_exists_in_loader(path)
+
+def _find_in_loader_archive(path):
+    # figure out if a PEP 302 loader is around that covers the path,
+    # and return it together with the archive name of the path
     try:
         loader = __loader__
-        # XXX the code below assumes a 'zipimport.zipimporter' instance
-        # XXX should be easy to generalize, but too lazy right now to write it
-        archive_path = getattr(loader, 'archive', None)
-        if archive_path:
-            normpath = os.path.normpath(path)
-            if normpath.startswith(archive_path):
-                arcname = normpath[len(archive_path)+1:]
-                try:
-                    loader.get_data(arcname)
-                    return True
-                except IOError:
-                    return False
     except NameError:
-        pass
-    return False
+        return None, None
+    # XXX the code below assumes a 'zipimport.zipimporter' instance
+    # XXX should be easy to generalize, but too lazy right now to write it
+    archive_path = getattr(loader, 'archive', None)
+    if archive_path:
+        normpath = os.path.normpath(path)
+        if normpath.startswith(archive_path):
+            return loader, normpath[len(archive_path)+1:]
+    return None, None
+
+def _in_loader_archive(path):
+    loader, _ = _find_in_loader_archive(path)
+    return loader is not None
+
+def _path_exists_in_loader(path):
+    loader, arcname = _find_in_loader_archive(path)
+    if loader is None:
+        return False
+    try:
+        loader.get_data(arcname)
+        return True
+    except IOError:
+        return False
 
 # file name encodings
 
+# The file system encoding does not change at runtime, so look it up only once.
+_filename_encoding = sys.getfilesystemencoding() or sys.getdefaultencoding()
+
 def decode_filename(filename):
     if isinstance(filename, bytes):
         try:
-            filename_encoding = sys.getfilesystemencoding()
-            if filename_encoding is None:
-                filename_encoding = sys.getdefaultencoding()
-            filename = filename.decode(filename_encoding)
+            filename = filename.decode(_filename_encoding)
         except UnicodeDecodeError:
             pass
     return filename
@@ -194,26 +272,34 @@ def decode_filename(filename):
 _match_file_encoding = re.compile(br"(\w*coding)[:=]\s*([-\w.]+)").search
 
 
-def detect_opened_file_encoding(f):
+def detect_opened_file_encoding(f, default='UTF-8'):
     # PEPs 263 and 3120
     # Most of the time the first two lines fall in the first couple of hundred chars,
-    # and this bulk read/split is much faster.
-    lines = ()
-    start = b''
-    while len(lines) < 3:
-        data = f.read(500)
+    # so a single bulk read is enough. Only very long lines require further reads.
+    chunk_size = 2048
+    start = data = f.read(chunk_size)
+    while len(data) == chunk_size and start.count(b"\n") < 2:
+        data = f.read(chunk_size)
         start += data
-        lines = start.split(b"\n")
-        if not data:
-            break
-    m = _match_file_encoding(lines[0])
+
+    # Only the first two lines can declare the encoding.
+    first_line_end = start.find(b"\n")
+    if first_line_end != -1:
+        second_line_end = start.find(b"\n", first_line_end + 1)
+        if second_line_end != -1:
+            start = start[:second_line_end]
+    if b'coding' not in start:
+        # Fast path for the vast majority of files: no encoding declaration.
+        return default
+
+    m = _match_file_encoding(start if first_line_end == -1 else start[:first_line_end])
     if m and m.group(1) != b'c_string_encoding':
         return m.group(2).decode('iso8859-1')
-    elif len(lines) > 1:
-        m = _match_file_encoding(lines[1])
+    elif first_line_end != -1:
+        m = _match_file_encoding(start[first_line_end + 1:])
         if m:
             return m.group(2).decode('iso8859-1')
-    return "UTF-8"
+    return default
 
 
 def skip_bom(f):
@@ -228,12 +314,19 @@ def skip_bom(f):
 
 def open_source_file(source_filename, encoding=None, error_handling=None):
     stream = None
+    bom_skipped = False
     try:
         if encoding is None:
             # Most of the time the encoding is not specified, so try hard to open the file only once.
             f = io.open(source_filename, 'rb')
             encoding = detect_opened_file_encoding(f)
             f.seek(0)
+            if codecs.lookup(encoding).name == 'utf-8':
+                # Handle the BOM at the byte level, which avoids decoding and discarding
+                # the first chunk of text in skip_bom().
+                if f.read(3) != codecs.BOM_UTF8:
+                    f.seek(0)
+                bom_skipped = True
             stream = io.TextIOWrapper(f, encoding=encoding, errors=error_handling)
         else:
             stream = io.open(source_filename, encoding=encoding, errors=error_handling)
@@ -253,7 +346,8 @@ def open_source_file(source_filename, encoding=None, error_handling=None):
 
     if stream is None:
         raise FileNotFoundError(source_filename)
-    skip_bom(stream)
+    if not bom_skipped:
+        skip_bom(stream)
     return stream
 
 
@@ -268,6 +362,12 @@ def open_source_from_loader(loader,
                             errors=error_handling)
 
 
+_literal_base_prefixes = {
+    'x': 16, 'X': 16,
+    'o': 8, 'O': 8,
+    'b': 2, 'B': 2,
+}
+
 def str_to_number(value):
     # note: this expects a string as input that was accepted by the
     # parser already, with an optional "-" sign in front
@@ -278,16 +378,10 @@ def str_to_number(value):
     if len(value) < 2:
         value = int(value, 0)
     elif value[0] == '0':
-        literal_type = value[1]  # 0'o' - 0'b' - 0'x'
-        if literal_type in 'xX':
-            # hex notation ('0x1AF')
-            value = int(value[2:], 16)
-        elif literal_type in 'oO':
-            # Py3 octal notation ('0o136')
-            value = int(value[2:], 8)
-        elif literal_type in 'bB':
-            # Py3 binary notation ('0b101')
-            value = int(value[2:], 2)
+        # 0'x' (hex), 0'o' (Py3 octal), 0'b' (Py3 binary)
+        base = _literal_base_prefixes.get(value[1])
+        if base is not None:
+            value = int(value[2:], base)
         else:
             # Py2 octal notation ('0136')
             value = int(value, 8)
@@ -333,16 +427,48 @@ def get_cython_cache_dir():
     return os.path.expanduser(os.path.join('~', '.cython'))
 
 
-@contextmanager
+class _TryFinallyGeneratorContextManager(object):
+    """
+    Fast, bare minimum @contextmanager, only for try-finally, not for exception handling.
+    """
+    __slots__ = ('_gen',)
+
+    def __init__(self, gen):
+        self._gen = gen
+
+    def __enter__(self):
+        return next(self._gen)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            next(self._gen)
+        except (StopIteration, GeneratorExit):
+            pass
+
+
+def try_finally_contextmanager(gen_func):
+    def make_gen(*args, **kwargs):
+        return _TryFinallyGeneratorContextManager(gen_func(*args, **kwargs))
+    make_gen.__name__ = gen_func.__name__
+    make_gen.__doc__ = gen_func.__doc__
+    make_gen.__wrapped__ = gen_func
+    return make_gen
+
+
+@try_finally_contextmanager
 def captured_fd(stream=2, encoding=None):
     orig_stream = os.dup(stream)  # keep copy of original stream
     try:
         with tempfile.TemporaryFile(mode="a+b") as temp_file:
-            def read_output(_output=[b'']):
+            captured = [b'']
+            def read_output():
                 if not temp_file.closed:
-                    temp_file.seek(0)
-                    _output[0] = temp_file.read()
-                return _output[0]
+                    # Only read what was written since the last call.
+                    temp_file.seek(len(captured[0]))
+                    data = temp_file.read()
+                    if data:
+                        captured[0] += data
+                return captured[0]
 
             os.dup2(temp_file.fileno(), stream)  # replace stream by copy of pipe
             try:
@@ -385,20 +511,34 @@ class LazyStr:
         return left + self.callback()
 
 
-class OrderedSet(object):
-  def __init__(self, elements=()):
-    self._list = []
-    self._set = set()
-    self.update(elements)
-  def __iter__(self):
-    return iter(self._list)
-  def update(self, elements):
-    for e in elements:
-      self.add(e)
-  def add(self, e):
-    if e not in self._set:
-      self._list.append(e)
-      self._set.add(e)
+if sys.version_info >= (3, 7):
+  # dicts are guaranteed to keep their insertion order
+  class OrderedSet(object):
+    __slots__ = ('_dict',)
+    def __init__(self, elements=()):
+      self._dict = dict.fromkeys(elements)
+    def __iter__(self):
+      return iter(self._dict)
+    def update(self, elements):
+      self._dict.update(dict.fromkeys(elements))
+    def add(self, e):
+      self._dict[e] = None
+
+else:
+  class OrderedSet(object):
+    def __init__(self, elements=()):
+      self._list = []
+      self._set = set()
+      self.update(elements)
+    def __iter__(self):
+      return iter(self._list)
+    def update(self, elements):
+      for e in elements:
+        self.add(e)
+    def add(self, e):
+      if e not in self._set:
+        self._list.append(e)
+        self._set.add(e)
 
 
 # Class decorator that adds a metaclass and recreates the class with it.
@@ -425,6 +565,8 @@ def raise_error_if_module_name_forbidden(full_module_name):
         raise ValueError('cython is a special module, cannot be used as a module name')
 
 
+_release_status_values = {'a': 0xA0, 'b': 0xB0, 'rc': 0xC0}
+
 def build_hex_version(version_string):
     """
     Parse and translate '4.3a1' into the readable hex representation '0x040300A1' (like PY_VERSION_HEX).
@@ -432,12 +574,29 @@ def build_hex_version(version_string):
     # First, parse '4.12a1' into [4, 12, 0, 0xA01].
     digits = []
     release_status = 0xF0
-    for digit in re.split('([.abrc]+)', version_string):
-        if digit in ('a', 'b', 'rc'):
-            release_status = {'a': 0xA0, 'b': 0xB0, 'rc': 0xC0}[digit]
-            digits = (digits + [0, 0])[:3]  # 1.2a1 -> 1.2.0a1
-        elif digit != '.':
-            digits.append(int(digit))
+    number = ''
+    separator = ''
+    for c in version_string + '.':  # the trailing '.' terminates the last number
+        if '0' <= c <= '9':
+            if separator:
+                if not digits:
+                    # leading separator, e.g. 'a1' or '.1'
+                    raise ValueError("Invalid version string: %r" % version_string)
+                if separator in _release_status_values:
+                    release_status = _release_status_values[separator]
+                    digits = (digits + [0, 0])[:3]  # 1.2a1 -> 1.2.0a1
+                elif separator != '.':
+                    raise ValueError("Invalid version string: %r" % version_string)
+                separator = ''
+            number += c
+        else:
+            if number:
+                digits.append(int(number))
+                number = ''
+            separator += c
+    if separator != '.' or not digits:
+        # trailing characters after the last number (e.g. '1.2b'), or no number at all
+        raise ValueError("Invalid version string: %r" % version_string)
     digits = (digits + [0] * 3)[:4]
     digits[3] += release_status
 